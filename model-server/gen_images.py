@@ -1,12 +1,26 @@
 import torch
-from diffusers import StableDiffusion3Pipeline
+from diffusers import AutoencoderTiny, StableDiffusion3Pipeline
+from diffusers.models.attention_processor import JointAttnProcessor2_0
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import argparse
+import json
 import os
+import queue
+import threading
 from tqdm import tqdm
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
 
+# Load the caption font once instead of for every image
+try:
+    _FONT = ImageFont.truetype("DejaVuSans.ttf", 24)
+except OSError:
+    _FONT = ImageFont.load_default()
+
+# Fused SDPA kernels only, never fall back to the unfused math implementation
+SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate images using Stable Diffusion 3')
     parser.add_argument('--prompt_file', type=str, default='prompts.txt',
@@ -21,85 +35,216 @@ def parse_args():
                         help='Negative prompt for generation')
     parser.add_argument('--batch_size', type=int, default=1,
                         help='Number of images to generate in parallel')
-    return parser.parse_args()
+    parser.add_argument('--use_t5', action='store_true',
+                        help='Load the T5-XXL text encoder for long prompts')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Quantize the transformer to FP8 with torchao (requires SM 8.9+)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for reproducible generation')
+    parser.add_argument('--preview', action='store_true',
+                        help='Decode with the tiny TAESD3 autoencoder for fast, lower quality previews')
+    parser.add_argument('--offload', type=str, default='none', choices=['none', 'model', 'sequential'],
+                        help='Offload pipeline components to CPU to reduce VRAM usage')
+    parser.add_argument('--t5_int8', action='store_true',
+                        help='Load the T5-XXL text encoder in 8-bit with bitsandbytes (implies --use_t5)')
+    args = parser.parse_args()
+    # Offload hooks move each component between CPU and GPU, which bitsandbytes models don't support
+    if args.t5_int8 and args.offload != 'none':
+        parser.error('--t5_int8 cannot be combined with --offload')
+    # Offload skips torch.compile, and dynamic FP8 is slower than BF16 without it;
+    # sequential offload would also restore the unquantized weights on every forward
+    if args.quantize and args.offload != 'none':
+        parser.error('--quantize cannot be combined with --offload')
+    return args
 
-def setup_pipeline():
+def setup_pipeline(use_t5=False, quantize=False, preview=False, offload='none', t5_int8=False):
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+    torch.cuda.set_per_process_memory_fraction(0.95)
+    
+    # SD3 works with only the two CLIP encoders; T5-XXL is opt-in for long prompts
+    if t5_int8:
+        # T5-XXL tolerates int8 well and this saves ~5GB of VRAM
+        from transformers import BitsAndBytesConfig, T5EncoderModel
+        t5_kwargs = {"text_encoder_3": T5EncoderModel.from_pretrained(
+            "stabilityai/stable-diffusion-3-medium-diffusers",
+            subfolder="text_encoder_3",
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            device_map={"": 0},
+            torch_dtype=torch.bfloat16
+        )}
+    elif use_t5:
+        t5_kwargs = {}
+    else:
+        t5_kwargs = {"text_encoder_3": None, "tokenizer_3": None}
     pipe = StableDiffusion3Pipeline.from_pretrained(
         "stabilityai/stable-diffusion-3-medium-diffusers",
+        **t5_kwargs,
         torch_dtype=torch.bfloat16
     )
-    return pipe.to("cuda")
+    pipe.set_progress_bar_config(disable=True)
+
+    if preview:
+        pipe.vae = AutoencoderTiny.from_pretrained(
+            "madebyollin/taesd3",
+            torch_dtype=torch.bfloat16
+        )
+    else:
+        # Decode in tiles / one image at a time to keep peak VRAM down for large batches
+        pipe.vae.enable_tiling()
+        pipe.vae.enable_slicing()
+    pipe.vae.to(memory_format=torch.channels_last)
+
+    if offload == 'model':
+        # Keep only the active component on the GPU
+        pipe.enable_model_cpu_offload()
+    elif offload == 'sequential':
+        # Stream weights layer by layer, slowest but fits in <8GB of VRAM
+        pipe.enable_sequential_cpu_offload()
+    else:
+        pipe = pipe.to("cuda")
+
+    if quantize:
+        # FP8 only pays off on Ada/Hopper, on older GPUs quantization can be slower than BF16
+        if torch.cuda.get_device_capability() >= (8, 9):
+            from torchao.quantization import quantize_, float8_dynamic_activation_float8_weight
+            quantize_(pipe.transformer, float8_dynamic_activation_float8_weight())
+        else:
+            print("Skipping quantization: FP8 requires a GPU with compute capability 8.9 or higher")
+
+    pipe.transformer.set_attn_processor(JointAttnProcessor2_0())
+    pipe.transformer.to(memory_format=torch.channels_last)
+    if offload == 'none':
+        # Compile the transformer and VAE decoder for fused kernels / CUDA graphs,
+        # CUDA graphs can't be captured while offload hooks move weights around
+        pipe.transformer = torch.compile(pipe.transformer, mode="reduce-overhead", fullgraph=True)
+        pipe.vae.decode = torch.compile(pipe.vae.decode, mode="reduce-overhead")
+    return pipe
+
+def warmup_pipeline(pipe, batch_size, guidance_scale):
+    # Run once with the target batch shape so compilation happens before the real prompts
+    with sdpa_kernel(SDPA_BACKENDS):
+        pipe(
+            ["warmup"] * batch_size,
+            num_inference_steps=2,
+            guidance_scale=guidance_scale,
+        )
 
 def read_prompts(prompt_file):
     with open(prompt_file, 'r') as f:
-        return [line.strip() for line in f.readlines() if line.strip()]
+        return [line for line in map(str.strip, f) if line]
 
 def add_text_to_image(image, prompt):
-    # Convert to RGB if necessary
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    
     # Create a new image with extra space for text
     margin = 60
     wrapped_text = textwrap.fill(prompt, width=60)
-    text_height = len(wrapped_text.split('\n')) * 30
+    bbox = ImageDraw.Draw(image).multiline_textbbox((0, 0), wrapped_text, font=_FONT)
+    text_height = bbox[3] - bbox[1]
     
-    new_img = Image.new('RGB', (image.width, image.height + margin + text_height), 'white')
+    new_img = Image.new('RGB', (image.width, image.height + margin + text_height), 0xFFFFFF)
     new_img.paste(image, (0, 0))
     
     # Add text
     draw = ImageDraw.Draw(new_img)
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", 24)
-    except:
-        font = ImageFont.load_default()
-    
     draw.text((10, image.height + margin/2), wrapped_text, 
-              font=font, fill='black')
+              font=_FONT, fill=0)
     
     return new_img
 
-def generate_images(pipe, prompts, output_dir, steps, guidance_scale, negative_prompt, batch_size):
+def save_image(image, prompt, global_idx, output_dir, log_file, log_lock):
+    try:
+        # Add text to image
+        image_with_text = add_text_to_image(image, prompt)
+        
+        # Save image
+        image_path = os.path.join(output_dir, f"generated_{global_idx:03d}.png")
+        image_with_text.save(image_path)
+        
+        # Log the prompt and corresponding filename
+        record = {"index": global_idx, "file": os.path.basename(image_path), "prompt": prompt}
+        with log_lock:
+            log_file.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"Error saving image {global_idx:03d}: {e}")
+
+def save_worker(image_queue, output_dir, log_file, log_lock):
+    # Consume (index, prompt, image) items until the None sentinel arrives
+    while True:
+        item = image_queue.get()
+        if item is None:
+            break
+        global_idx, prompt, image = item
+        save_image(image, prompt, global_idx, output_dir, log_file, log_lock)
+
+def generate_images(pipe, prompts, output_dir, steps, guidance_scale, negative_prompt, batch_size, seed):
     os.makedirs(output_dir, exist_ok=True)
     
-    # Process prompts in batches
-    for batch_start in tqdm(range(0, len(prompts), batch_size), desc="Processing batches"):
-        batch_end = min(batch_start + batch_size, len(prompts))
-        batch_prompts = prompts[batch_start:batch_end]
+    # A single generator shared by all batches keeps the whole run reproducible
+    generator = torch.Generator(device="cuda").manual_seed(seed)
+    
+    # The negative prompt is the same for every batch, so encode it only once
+    with torch.no_grad():
+        neg_embeds, _, neg_pooled, _ = pipe.encode_prompt(
+            prompt=negative_prompt,
+            prompt_2=negative_prompt,
+            prompt_3=negative_prompt,
+            do_classifier_free_guidance=False,
+            device="cuda"
+        )
+    
+    # Overlay text, save images and write the log in consumer threads so the
+    # GPU can start on the next batch right away; the bounded queue applies
+    # back-pressure if saving falls behind
+    num_workers = 3
+    image_queue = queue.Queue(maxsize=2)
+    log_lock = threading.Lock()
+    with open(os.path.join(output_dir, "generation_log.jsonl"), "a", buffering=1) as log_file:
+        workers = [
+            threading.Thread(target=save_worker, args=(image_queue, output_dir, log_file, log_lock))
+            for _ in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
         
         try:
-            # Generate images for the batch
-            batch_images = pipe(
-                batch_prompts,
-                negative_prompt=[negative_prompt] * len(batch_prompts),
-                num_inference_steps=steps,
-                guidance_scale=guidance_scale,
-            ).images
-            
-            # Save each image in the batch
-            for idx, (prompt, image) in enumerate(zip(batch_prompts, batch_images)):
-                global_idx = batch_start + idx
-                
-                # Add text to image
-                image_with_text = add_text_to_image(image, prompt)
-                
-                # Save image
-                image_path = os.path.join(output_dir, f"generated_{global_idx:03d}.png")
-                image_with_text.save(image_path)
-                
-                # Log the prompt and corresponding filename
-                with open(os.path.join(output_dir, "generation_log.txt"), "a") as f:
-                    f.write(f"Image {global_idx:03d}: {prompt}\n")
+            # Process prompts in batches
+            for batch_start in tqdm(range(0, len(prompts), batch_size), desc="Processing batches"):
+                batch_end = min(batch_start + batch_size, len(prompts))
+                batch_prompts = prompts[batch_start:batch_end]
                 
-        except Exception as e:
-            print(f"Error generating batch starting at index {batch_start}: {e}")
-            continue
+                try:
+                    # Generate images for the batch
+                    with sdpa_kernel(SDPA_BACKENDS):
+                        batch_images = pipe(
+                            batch_prompts,
+                            negative_prompt_embeds=neg_embeds.expand(len(batch_prompts), -1, -1),
+                            negative_pooled_prompt_embeds=neg_pooled.expand(len(batch_prompts), -1),
+                            num_inference_steps=steps,
+                            guidance_scale=guidance_scale,
+                            generator=generator,
+                        ).images
+                    
+                    # Hand each image in the batch to the save workers
+                    for idx, (prompt, image) in enumerate(zip(batch_prompts, batch_images)):
+                        image_queue.put((batch_start + idx, prompt, image))
+                        
+                except Exception as e:
+                    print(f"Error generating batch starting at index {batch_start}: {e}")
+                    continue
+        finally:
+            for _ in workers:
+                image_queue.put(None)
+            for worker in workers:
+                worker.join()
 
 def main():
     args = parse_args()
     
     # Setup pipeline
-    pipe = setup_pipeline()
+    pipe = setup_pipeline(args.use_t5, args.quantize, args.preview, args.offload, args.t5_int8)
+    if args.offload == 'none':
+        # Only the compiled (non-offloaded) pipeline needs warming up
+        warmup_pipeline(pipe, args.batch_size, args.guidance_scale)
     
     # Read prompts
     prompts = read_prompts(args.prompt_file)
@@ -112,7 +257,8 @@ def main():
         args.steps,
         args.guidance_scale,
         args.negative_prompt,
-        args.batch_size
+        args.batch_size,
+        args.seed
     )
 
 if __name__ == "__main__":